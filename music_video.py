@@ -2,12 +2,28 @@
 import streamlit as st 
 import tempfile
 import os
+import shutil
 from PIL import Image
 import numpy as np
-from moviepy.editor import VideoFileClip, AudioFileClip, ImageClip, concatenate_videoclips, CompositeVideoClip
-from moviepy.video.VideoClip import ColorClip
+from moviepy.editor import VideoFileClip, ImageClip, VideoClip
+from moviepy.video.fx.loop import loop as vfx_loop
 import cv2
 import mimetypes
+import math
+import io
+import re
+import subprocess
+import atexit
+import threading
+import time
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from moviepy.config import get_setting
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 st.set_page_config(page_title="🎬 PS Video", layout="centered")
 st.markdown('<style>[data-testid="stSidebar"]{display:none}.stButton>button{width:100%}</style>', unsafe_allow_html=True)
@@ -25,11 +41,147 @@ PRESETS = {
     "📱 9:16 Portrait (540x960) - Small/Fast": (540, 960),
 }
 
+# Encoder settings shared by the MoviePy and ffmpeg render paths
+FFMPEG_BINARY = get_setting("FFMPEG_BINARY")
+VIDEO_CODEC = "libx264"
+AUDIO_CODEC = "aac"
+VIDEO_BITRATE = "5M"
+# MoviePy fallback renders in parallel parts of at least this many seconds, one decoder + encoder each
+RENDER_WORKERS = min(4, os.cpu_count() or 1)
+MIN_PART_SECONDS = 10
+FRAME_PIPE_SIZE = 1 << 20  # Linux pipe buffer for raw frames to ffmpeg (default 64KB; 1MB is the unprivileged max)
+ENCODE_SPEEDS = ["ultrafast", "veryfast", "faster", "medium"]  # x264 preset names offered in the UI
+ENCODE_PRESET = "veryfast"  # ~3-4x faster than medium, indistinguishable at mobile bitrates
+ENCODE_THREADS = 0  # 0 = x264 sizes its thread pool from the host's core count
+# moov atom up front so playback starts before the download finishes
+ENCODE_FLAGS = ["-movflags", "+faststart"]
+# Cheap-to-decode stream for phones (x264 only; hardware encoders reject x264 tunes)
+X264_FLAGS = ["-tune", "fastdecode"]
+# Overlay codecs that can go into the MP4 as-is when no pixels change (H.264 plays everywhere)
+COPY_VIDEO_CODECS = {"h264"}
+# Background audio codecs that go into the MP4 without re-encoding (cut on packet boundaries, ~20ms)
+COPY_AUDIO_CODECS = {"aac"}
+
+# Hardware H.264 encoders in order of preference -> their names for ENCODE_SPEEDS
+# (None = takes the x264 names); libx264 is the software fallback
+HW_ENCODERS = {
+    "h264_nvenc": {"ultrafast": "p1", "veryfast": "p2", "faster": "p3", "medium": "p4"},
+    "h264_qsv": {"ultrafast": "veryfast", "veryfast": "veryfast", "faster": "faster", "medium": "medium"},  # no ultrafast
+    "h264_videotoolbox": None,  # has no presets, ffmpeg ignores it
+}
+
+# Keep uploads and renders on RAM-backed tmpfs on Linux (skipped if it's missing or small, e.g. Docker's 64MB default)
+SHM_TMPDIR = "/dev/shm/psvideo"
+SHM_MIN_FREE = 2 * 1024**3  # tmpfs free space needed at startup to use it at all
+SHM_HEADROOM = 512 * 1024**2  # free space each new file must leave on it (renders grow while being written)
+
+# Temp files we create are prefixed so stale ones from crashed/old sessions can be swept
+TEMP_PREFIX = "psvideo_"
+TEMP_MAX_AGE = 6 * 3600
+TEMP_SWEEP_INTERVAL = 15 * 60  # sweep at most this often per server process
+
 # Initialize session state
 for k, v in {'bg_dur': 0.0, 'ov_dur': 0.0, 'a_trim': [0.0, 30.0], 'v_trim': [0.0, 30.0], 'img_dur': 5.0,
-             'bg_path': '', 'ov_path': '', 'bg_name': '', 'ov_name': '', 'is_img': False}.items():
+             'bg_path': '', 'ov_path': '', 'bg_name': '', 'ov_name': '', 'is_img': False,
+             'bg_valid': False, 'ov_valid': False, 'out_path': '', 'img_arr': None, 'ov_meta': None,
+             'bg_key': None, 'ov_key': None}.items():
     st.session_state.setdefault(k, v)
 
+def unlink_quietly(path):
+    """Unlink a file, ignoring files that are already gone"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def sweep_stale_temp_files(temp_dirs, registry):
+    """Remove our temp files unused for TEMP_MAX_AGE from `temp_dirs` (left behind by closed sessions)
+
+    Last use is the later of atime/mtime - touch_temp_file refreshes atime whenever a session uses a file.
+    """
+    cutoff = time.time() - TEMP_MAX_AGE
+    for temp_dir in temp_dirs:
+        try:
+            for entry in os.scandir(temp_dir):
+                if not entry.name.startswith(TEMP_PREFIX):
+                    continue
+                stat = entry.stat()
+                if max(stat.st_atime, stat.st_mtime) < cutoff:
+                    registry.discard(entry.path)
+                    unlink_quietly(entry.path)
+        except OSError:
+            pass
+
+
+def touch_temp_file(path, stat=None):
+    """Mark a temp file as just used so the sweep keeps it
+
+    Only atime moves: mtime is part of probe_media's cache key. Raises FileNotFoundError if it was swept.
+    """
+    stat = stat or os.stat(path)
+    os.utime(path, (time.time(), stat.st_mtime))
+
+@st.cache_resource(show_spinner=False)
+def shm_tmpdir():
+    """RAM-backed temp dir for this server process, or None; decided once per process, not on every rerun"""
+    try:
+        if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= SHM_MIN_FREE:
+            os.makedirs(SHM_TMPDIR, exist_ok=True)
+            return SHM_TMPDIR
+    except OSError:
+        pass
+    return None
+
+def temp_dir_for(size):
+    """Directory for a new temp file of about `size` bytes: tmpfs while it fits, else the default temp dir (None)"""
+    shm = shm_tmpdir()
+    try:
+        if shm and shutil.disk_usage(shm).free >= size + SHM_HEADROOM:
+            return shm
+    except OSError:
+        pass
+    return None
+
+@st.cache_resource(show_spinner=False)
+def temp_registry():
+    """Temp files created by this server process; whatever is left is removed at exit"""
+    paths = set()
+    atexit.register(lambda: [unlink_quietly(p) for p in list(paths)])
+    return paths
+
+@st.cache_resource(show_spinner=False)
+def sweep_state():
+    """When this server process last started a stale-file sweep"""
+    return {'last': 0.0, 'lock': threading.Lock()}
+
+def schedule_temp_sweep():
+    """Start a background sweep unless one ran in the last TEMP_SWEEP_INTERVAL"""
+    state = sweep_state()
+    with state['lock']:
+        now = time.time()
+        if now - state['last'] < TEMP_SWEEP_INTERVAL:
+            return
+        state['last'] = now
+    temp_dirs = {tempfile.gettempdir(), shm_tmpdir() or tempfile.gettempdir()}
+    threading.Thread(target=sweep_stale_temp_files, args=(temp_dirs, temp_registry()), daemon=True).start()
+
+def remove_temp_file(path):
+    """Unlink a temp file we created and forget it"""
+    if path:
+        temp_registry().discard(path)
+        unlink_quietly(path)
+
+def new_temp_path(suffix, size=0):
+    """Create an empty, registered temp file (for about `size` bytes) and sweep stale ones in the background"""
+    with tempfile.NamedTemporaryFile(delete=False, prefix=TEMP_PREFIX, suffix=suffix, dir=temp_dir_for(size)) as tmp:
+        temp_registry().add(tmp.name)
+    schedule_temp_sweep()
+    return tmp.name
+
+def upload_key(f):
+    """Identity of an uploaded file - a new upload gets a new file_id even if the name is the same"""
+    return getattr(f, 'file_id', None) or (f.name, f.size)
+
 def save_file(f):
     # Get file extension
     _, ext = os.path.splitext(f.name)
@@ -40,10 +192,12 @@ def save_file(f):
     
     # Use .tmp extension if no extension found
     suffix = ext if ext else '.tmp'
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    tmp.write(f.getvalue())
-    tmp.close()
-    return tmp.name
+    # Stream in 1MB chunks instead of materializing the whole upload as bytes
+    path = new_temp_path(suffix, f.size)
+    with open(path, "wb") as tmp:
+        f.seek(0)
+        shutil.copyfileobj(f, tmp, 1 << 20)
+    return path
 
 def is_audio_file(file_path):
     """Check if file is an audio file based on extension and content"""
@@ -60,10 +214,7 @@ def is_audio_file(file_path):
     # For video files, check if it has audio
     if ext in {'.mp4', '.mov', '.avi', '.mkv', '.webm'}:
         try:
-            clip = VideoFileClip(file_path)
-            has_audio = clip.audio is not None
-            clip.close()
-            return has_audio
+            return probe(file_path)['has_audio']
         except:
             return False
     
@@ -75,6 +226,53 @@ def is_video_file(file_path):
     _, ext = os.path.splitext(file_path)
     return ext.lower() in video_extensions
 
+def parse_ffmpeg_listing(listing):
+    """Metadata from `ffmpeg -i`'s header listing (the same text MoviePy's ffmpeg_parse_infos parses)"""
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", listing)
+    if not duration:
+        raise ValueError("could not read the file's duration")
+    hours, minutes, seconds = duration.groups()
+    video = re.search(r"Stream #.*?: Video: (\w+).*", listing)
+    audio = re.search(r"Stream #.*?: Audio: (\w+)", listing)
+    info = {'is_video': bool(video), 'duration': int(hours) * 3600 + int(minutes) * 60 + float(seconds),
+            'has_audio': bool(audio), 'size': None, 'fps': None,
+            'video_codec': video and video.group(1), 'audio_codec': audio and audio.group(1)}
+    info['audio_duration'] = info['duration'] if info['has_audio'] else 0.0
+    if video:
+        line = video.group(0)
+        size = re.search(r" (\d+)x(\d+)[, ]", line)
+        if not size:
+            raise ValueError("could not read the video's frame size")
+        w, h = int(size.group(1)), int(size.group(2))
+        # Same as VideoFileClip: rotated phone videos report their display size
+        # (older ffmpeg prints a `rotate` tag, newer a display-matrix rotation)
+        rotation = re.search(r"rotate\s*:\s*(-?\d+)|rotation of (-?[\d.]+) degrees", listing)
+        if rotation and abs(round(float(rotation.group(1) or rotation.group(2)))) % 180 == 90:
+            w, h = h, w
+        rate = re.search(r"([\d.]+) fps", line) or re.search(r"([\d.]+) tbr", line)
+        fps = float(rate.group(1)) if rate else None
+        # ffmpeg rounds NTSC rates (23.98 for 24000/1001); use the exact value like MoviePy does
+        for x in (24, 30, 60):
+            if fps and fps != x and abs(fps - x / 1.001) < .01:
+                fps = x / 1.001
+        info.update(size=(w, h), fps=fps)
+    return info
+
+@st.cache_data(show_spinner=False)
+def probe_media(file_path, mtime, size):
+    """Read a media file's stream headers once and return its metadata; cached per (path, mtime, size)
+
+    A single `ffmpeg -i` gives durations, size, fps and codecs - no decoder or reader process is started.
+    """
+    result = subprocess.run([FFMPEG_BINARY, "-hide_banner", "-i", file_path], capture_output=True)
+    return parse_ffmpeg_listing(result.stderr.decode(errors="ignore"))
+
+def probe(file_path):
+    """Cached probe_media lookup, keyed so a rewritten file is probed again"""
+    stat = os.stat(file_path)
+    touch_temp_file(file_path, stat)
+    return probe_media(file_path, stat.st_mtime, stat.st_size)
+
 def is_image_file(file_path):
     """Check if file is an image file"""
     image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
@@ -84,10 +282,27 @@ def is_image_file(file_path):
 def fmt_time(s):
     return f"{int(s//60):02d}:{int(s%60):02d}" if s < 3600 else f"{int(s//3600):02d}:{int((s%3600)//60):02d}:{int(s%60):02d}"
 
-def resize_frame(frame, target_size):
-    """Resize frame using cv2 (no PIL issues)"""
+def fmt_aspect(size):
+    """Aspect ratio as "16:9", or "1.78:1" when it doesn't reduce to small numbers"""
+    w, h = size
+    g = math.gcd(w, h)
+    return f"{w//g}:{h//g}" if max(w, h) // g <= 32 else f"{w/h:.2f}:1"
+
+def decode_image_rgb(data):
+    """Decode in-memory image bytes (e.g. the upload buffer) straight to an RGB uint8 array, without touching disk
+
+    cv2 first; PIL only for formats cv2 can't read (e.g. GIF).
+    """
+    arr = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if arr is None:
+        return np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+    # Swap channels in place - no extra copy
+    return cv2.cvtColor(arr, cv2.COLOR_BGR2RGB, dst=arr)
+
+def letterbox_geometry(src_size, target_size):
+    """Fit src (w, h) inside target: returns (new_w, new_h, x_offset, y_offset)"""
     target_w, target_h = target_size
-    h, w = frame.shape[:2]
+    w, h = src_size
     
     # Calculate scale to fit inside target
     scale = min(target_w / w, target_h / h)
@@ -97,22 +312,400 @@ def resize_frame(frame, target_size):
     new_w = new_w if new_w % 2 == 0 else new_w - 1
     new_h = new_h if new_h % 2 == 0 else new_h - 1
     
-    # Resize using cv2
-    resized = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LANCZOS4)
+    # Center offsets
+    return new_w, new_h, (target_w - new_w) // 2, (target_h - new_h) // 2
+
+def resize_interpolation(src_size, new_size, high_quality=False):
+    """INTER_AREA to shrink, INTER_CUBIC to enlarge (both SIMD); Lanczos4 only for enlarging, when asked for.
+
+    OpenCV's 8-bit Lanczos4 has no vectorized path, and area averaging is the better downscale anyway.
+    """
+    w, new_w = src_size[0], new_size[0]
+    if new_w < w:
+        return cv2.INTER_AREA
+    return cv2.INTER_LANCZOS4 if high_quality else cv2.INTER_CUBIC
+
+def scale_flags(src_size, new_size, high_quality=False):
+    """ffmpeg (swscale) counterpart of resize_interpolation, for the `flags=` / `-sws_flags` of a scale"""
+    if src_size and new_size[0] < src_size[0]:
+        return "area"
+    return "lanczos" if high_quality else "bicubic"
+
+def resize_frame(frame, target_size, high_quality=False):
+    """Resize frame using cv2 (no PIL issues)"""
+    target_w, target_h = target_size
+    # cv2's vectorized paths want C-contiguous uint8 (no-op when it already is)
+    frame = np.ascontiguousarray(frame, dtype=np.uint8)
+    h, w = frame.shape[:2]
+    new_w, new_h, x_offset, y_offset = letterbox_geometry((w, h), target_size)
+    interpolation = resize_interpolation((w, h), (new_w, new_h), high_quality)
+    
+    # Same aspect ratio: the resized frame fills the target, no bars to draw
+    if (new_w, new_h) == (target_w, target_h):
+        return cv2.resize(frame, (new_w, new_h), interpolation=interpolation)
     
     # Create black canvas
     canvas = np.zeros((target_h, target_w, 3), dtype=np.uint8)
     
-    # Center the resized frame
-    y_offset = (target_h - new_h) // 2
-    x_offset = (target_w - new_w) // 2
-    canvas[y_offset:y_offset+new_h, x_offset:x_offset+new_w] = resized
+    # Resize using cv2 straight into the centered region of the canvas
+    cv2.resize(frame, (new_w, new_h), dst=canvas[y_offset:y_offset+new_h, x_offset:x_offset+new_w],
+               interpolation=interpolation)
     
     return canvas
 
-def apply_resize_to_clip(clip, target_size):
-    """Apply resize to every frame using cv2"""
-    return clip.fl_image(lambda frame: resize_frame(frame, target_size))
+@st.cache_data(show_spinner=False)
+def cuda_available():
+    """Whether this OpenCV build can resize on a CUDA GPU (the pip opencv-python builds can't)"""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+def apply_resize_to_clip(clip, target_size, high_quality=False, use_cuda=False):
+    """Apply resize to every frame using cv2 (area/cubic on the GPU with `use_cuda`, see cuda_available())
+
+    Geometry and the black canvas are computed once per clip; each frame is resized straight into
+    the same canvas. MoviePy hands a frame to the writer before asking for the next, so reuse is safe.
+    """
+    target_w, target_h = target_size
+    # Already the right size: nothing to do per frame
+    if tuple(clip.size) == (target_w, target_h):
+        return clip
+    
+    new_w, new_h, x_offset, y_offset = letterbox_geometry(clip.size, target_size)
+    interpolation = resize_interpolation(clip.size, (new_w, new_h), high_quality)
+    canvas = np.zeros((target_h, target_w, 3), dtype=np.uint8)
+    region = canvas[y_offset:y_offset+new_h, x_offset:x_offset+new_w]
+    
+    # CUDA resize has no Lanczos, so an explicit High quality request always stays on the CPU
+    if use_cuda and interpolation != cv2.INTER_LANCZOS4:
+        # GPU buffers are allocated once too
+        src, dst = cv2.cuda_GpuMat(), cv2.cuda_GpuMat()
+        scaled = np.empty((new_h, new_w, 3), dtype=np.uint8)
+        
+        def resize_gpu(frame, cuda_resize=cv2.cuda.resize, copyto=np.copyto, src=src, dst=dst, size=(new_w, new_h),
+                       interpolation=interpolation, scaled=scaled, region=region, canvas=canvas):
+            src.upload(frame)
+            cuda_resize(src, size, dst=dst, interpolation=interpolation)
+            dst.download(scaled)
+            copyto(region, scaled)
+            return canvas
+        
+        return clip.fl_image(resize_gpu)
+    
+    # Everything the frame function needs is bound as default args: plain locals, no closure-cell lookups
+    def resize(frame, cv_resize=cv2.resize, size=(new_w, new_h), region=region, interpolation=interpolation,
+               canvas=canvas):
+        cv_resize(frame, size, dst=region, interpolation=interpolation)
+        return canvas
+    
+    return clip.fl_image(resize)
+
+def pad_clip(clip, target_size):
+    """Center an already-scaled clip on a black target-size canvas (padding only, no resampling)"""
+    target_w, target_h = target_size
+    w, h = clip.size
+    if (w, h) == (target_w, target_h):
+        return clip
+    
+    x_offset, y_offset = (target_w - w) // 2, (target_h - h) // 2
+    canvas = np.zeros((target_h, target_w, 3), dtype=np.uint8)
+    region = canvas[y_offset:y_offset+h, x_offset:x_offset+w]
+    
+    def pad(frame, copyto=np.copyto, region=region, canvas=canvas):
+        copyto(region, frame)
+        return canvas
+    
+    return clip.fl_image(pad)
+
+@st.cache_data(show_spinner=False)
+def pick_video_codec():
+    """Pick the fastest working H.264 encoder: NVENC > QuickSync > VideoToolbox, else libx264.
+
+    An encoder being compiled into ffmpeg doesn't mean the hardware is present, so each
+    candidate gets a tiny test encode. Anything that fails falls back to software libx264.
+    """
+    try:
+        listed = subprocess.run([FFMPEG_BINARY, "-hide_banner", "-encoders"], capture_output=True, text=True).stdout
+    except OSError:
+        return VIDEO_CODEC
+    for codec in HW_ENCODERS:
+        if codec not in listed:
+            continue
+        test = subprocess.run([FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+                               "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+                               "-c:v", codec, "-preset", encoder_preset(codec), "-f", "null", "-"], capture_output=True)
+        if test.returncode == 0:
+            return codec
+    return VIDEO_CODEC
+
+def encoder_preset(codec, speed=ENCODE_PRESET):
+    """Encoder-specific preset name for one of ENCODE_SPEEDS"""
+    names = HW_ENCODERS.get(codec)
+    return names[speed] if names else speed
+
+def encoder_flags(codec, still=False):
+    """Extra ffmpeg output flags for the chosen video encoder"""
+    if codec != VIDEO_CODEC:
+        return list(ENCODE_FLAGS)
+    if still:
+        # Constant frame: x264 codes one I-frame and near-empty P-frames after it
+        return ["-tune", "stillimage,fastdecode", *ENCODE_FLAGS]
+    return [*X264_FLAGS, *ENCODE_FLAGS]
+
+def encoder_args(codec, speed=ENCODE_PRESET, still=False, threads=ENCODE_THREADS):
+    """ffmpeg output args for the chosen video encoder"""
+    return ["-c:v", codec, "-preset", encoder_preset(codec, speed), "-b:v", VIDEO_BITRATE, "-pix_fmt", "yuv420p",
+            "-threads", str(threads), *encoder_flags(codec, still)]
+
+def output_size(src_size, target_size):
+    """Frame size the ffmpeg render paths produce for a source of `src_size`"""
+    if target_size:
+        return tuple(target_size)
+    w, h = src_size
+    return w - w % 2, h - h % 2
+
+def scale_pad_filter(target_size, high_quality=False, src_size=None):
+    """ffmpeg filter equivalent of resize_frame: fit inside target, even dims, centered on black
+
+    With a known `src_size` the scaler matches resize_frame's filter choice (area when shrinking).
+    """
+    if not target_size:
+        # Keep original size, just make it even (yuv420p needs it)
+        return "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    target_w, target_h = target_size
+    new_size = letterbox_geometry(src_size, target_size)[:2] if src_size else target_size
+    flags = scale_flags(src_size, new_size, high_quality)
+    return (f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease:force_divisible_by=2:flags={flags},"
+            f"pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2:black,setsar=1")
+
+def run_ffmpeg(cmd):
+    """Run an ffmpeg command, raising RuntimeError with ffmpeg's message on failure"""
+    try:
+        subprocess.run(cmd, capture_output=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(e.stderr.decode(errors="ignore").strip()) from e
+    except OSError as e:
+        raise RuntimeError(str(e)) from e
+
+@dataclasses.dataclass(frozen=True)
+class Pipeline:
+    """What to render, as plain values from the UI.
+
+    Nothing is opened or decoded until a render function runs it: the ffmpeg renderers turn it into
+    one command, and only the MoviePy fallback builds a (video-only) clip.
+    """
+    bg_path: str
+    ov_path: str
+    is_img: bool
+    a_trim: tuple
+    v_trim: tuple
+    img_dur: float
+    target_dims: Optional[tuple]
+    fps: float
+    codec: str = VIDEO_CODEC
+    high_quality: bool = False
+    speed: str = ENCODE_PRESET
+    use_ffmpeg: bool = True  # False forces the MoviePy frame pipeline
+    copy_audio: bool = False  # background audio is already in COPY_AUDIO_CODECS
+    src_size: Optional[tuple] = None  # overlay (w, h), when known
+    
+    @property
+    def duration(self):
+        return self.a_trim[1] - self.a_trim[0]
+    
+    @property
+    def needs_loop(self):
+        return self.v_trim[1] - self.v_trim[0] < self.duration
+    
+    @property
+    def audio_args(self):
+        """ffmpeg output args for the audio stream"""
+        return ["-c:a", "copy"] if self.copy_audio else ["-c:a", AUDIO_CODEC]
+
+def ffmpeg_can_render(pipe, ov_duration):
+    """Whether the video overlay fits one ffmpeg pipeline.
+
+    `-stream_loop` always restarts from the top of the file, so a partial segment that needs looping can't.
+    """
+    return not pipe.needs_loop or (pipe.v_trim[0] == 0 and pipe.v_trim[1] >= ov_duration)
+
+def can_stream_copy(pipe, ov_meta):
+    """Original size and no loop: the overlay's video stream can be muxed as-is, without decoding"""
+    return (not pipe.is_img and pipe.target_dims is None and not pipe.needs_loop
+            and ov_meta.get('codec') in COPY_VIDEO_CODECS)
+
+def render_copy_ffmpeg(pipe, out_path):
+    """Trim the overlay and mux it with the audio segment, copying the video stream (no decode or encode).
+
+    With `-c:v copy` the cut starts at the keyframe before `v_trim[0]`. Only valid when can_stream_copy() is true.
+    """
+    duration = f"{pipe.duration:.3f}"
+    cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error",
+           "-ss", f"{pipe.v_trim[0]:.3f}", "-t", duration, "-i", pipe.ov_path,
+           "-ss", f"{pipe.a_trim[0]:.3f}", "-t", duration, "-i", pipe.bg_path,
+           "-map", "0:v:0", "-map", "1:a:0", "-t", duration,
+           "-c:v", "copy", *pipe.audio_args, *ENCODE_FLAGS, out_path]
+    run_ffmpeg(cmd)
+
+def render_with_ffmpeg(pipe, out_path):
+    """Trim or loop, letterbox and mux the overlay video with the audio segment in one ffmpeg call.
+
+    Decode, scale, pad, loop and encode all stay inside ffmpeg - no frames pass through Python.
+    Only valid when ffmpeg_can_render() is true.
+    """
+    ov_path, bg_path, a_trim, v_trim = pipe.ov_path, pipe.bg_path, pipe.a_trim, pipe.v_trim
+    duration = f"{pipe.duration:.3f}"
+    if pipe.needs_loop:
+        # `-stream_loop -1` restarts the input inside the demuxer, no clip copies or extra readers
+        ov_input = ["-stream_loop", "-1", "-i", ov_path]
+    else:
+        ov_input = ["-ss", f"{v_trim[0]:.3f}", "-t", duration, "-i", ov_path]
+    cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error", *ov_input,
+           "-ss", f"{a_trim[0]:.3f}", "-t", duration, "-i", bg_path,
+           "-map", "0:v:0", "-map", "1:a:0", "-t", duration,
+           "-vf", scale_pad_filter(pipe.target_dims, pipe.high_quality, pipe.src_size), "-r", str(pipe.fps),
+           *encoder_args(pipe.codec, pipe.speed), *pipe.audio_args, out_path]
+    run_ffmpeg(cmd)
+
+def render_still_ffmpeg(pipe, img_path, out_path):
+    """Encode a still image over the audio segment directly with ffmpeg (no MoviePy frame loop).
+
+    The image shows for `img_dur` seconds, then black until the audio ends - same as the MoviePy path.
+    """
+    a_trim, duration = pipe.a_trim, pipe.duration
+    img_dur = min(pipe.img_dur, duration)
+    # yuv420p needs even dimensions
+    filters = [scale_pad_filter(pipe.target_dims, pipe.high_quality, pipe.src_size)]
+    if img_dur < duration:
+        filters.append(f"tpad=stop_mode=add:stop_duration={duration - img_dur:.3f}:color=black")
+    cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error",
+           "-loop", "1", "-framerate", str(pipe.fps), "-t", f"{img_dur:.3f}", "-i", img_path,
+           "-ss", f"{a_trim[0]:.3f}", "-t", f"{duration:.3f}", "-i", pipe.bg_path,
+           "-map", "0:v:0", "-map", "1:a:0", "-vf", ",".join(filters), "-t", f"{duration:.3f}",
+           *encoder_args(pipe.codec, pipe.speed, still=True), *pipe.audio_args, out_path]
+    run_ffmpeg(cmd)
+
+def frame_count(pipe):
+    """Frames in the output (same count MoviePy's iter_frames would produce)"""
+    return math.ceil(round(pipe.duration * pipe.fps, 6))
+
+def render_clip_ffmpeg(clip, pipe, out_path, frames=None, audio=True, threads=ENCODE_THREADS):
+    """Encode a MoviePy clip's frames with our own ffmpeg process, muxing the audio segment in the same call.
+
+    Raw RGB frames go down one (enlarged) stdin pipe; ffmpeg reads the audio straight from the background
+    file, so MoviePy never decodes the audio or writes a temp audio track. `frames` limits the encode to a
+    (first, stop) frame-index range; `audio=False` writes video only; `threads` caps the encoder's thread pool.
+    Returns the output size.
+    """
+    w, h = clip.size
+    first, stop = frames or (0, frame_count(pipe))
+    duration = f"{pipe.duration:.3f}"
+    cmd = [FFMPEG_BINARY, "-y", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{w}x{h}", "-r", str(pipe.fps), "-i", "-"]
+    if audio:
+        cmd += ["-ss", f"{pipe.a_trim[0]:.3f}", "-t", duration, "-i", pipe.bg_path,
+                "-map", "0:v:0", "-map", "1:a:0", "-t", duration]
+    if w % 2 or h % 2:
+        # yuv420p needs even dimensions
+        cmd += ["-vf", scale_pad_filter(None)]
+    cmd += encoder_args(pipe.codec, pipe.speed, still=pipe.is_img, threads=threads)
+    if audio:
+        cmd += pipe.audio_args
+    cmd.append(out_path)
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise RuntimeError(str(e)) from e
+    if fcntl and hasattr(fcntl, "F_SETPIPE_SZ"):
+        try:
+            fcntl.fcntl(proc.stdin.fileno(), fcntl.F_SETPIPE_SZ, FRAME_PIPE_SIZE)
+        except OSError:
+            pass
+    try:
+        for i in range(first, stop):
+            proc.stdin.write(np.ascontiguousarray(clip.get_frame(i / pipe.fps), dtype=np.uint8).data)
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its error is reported below
+    finally:
+        _, err = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(err.decode(errors="ignore").strip())
+    return output_size((w, h), None)
+
+def build_overlay_clip(pipe, ov_meta, use_cuda=False):
+    """MoviePy fallback for the video overlay: trimmed or looped to the audio and letterboxed.
+
+    Returns (source clip to close when done, final clip). Makes no st.* calls, so worker threads can use it.
+    """
+    if pipe.target_dims and ov_meta and not pipe.high_quality:
+        # ffmpeg scales to the fitted size while decoding; only the black bars are left to draw
+        # (cheaper than piping full-size frames out for a GPU resize, so use_cuda doesn't apply here)
+        dec_w, dec_h, _, _ = letterbox_geometry((ov_meta['w'], ov_meta['h']), pipe.target_dims)
+        ov_clip = VideoFileClip(pipe.ov_path, audio=False, target_resolution=(dec_h, dec_w),
+                                resize_algorithm=scale_flags((ov_meta['w'], ov_meta['h']), (dec_w, dec_h)))
+    else:
+        ov_clip = VideoFileClip(pipe.ov_path, audio=False)
+    
+    segment = ov_clip.subclip(*pipe.v_trim)
+    if segment.duration < pipe.duration:
+        # Loop the video (time-mapped t % duration, single reader)
+        clip = vfx_loop(segment, duration=pipe.duration)
+    else:
+        clip = segment.subclip(0, pipe.duration)
+    
+    if pipe.target_dims:
+        if ov_meta and not pipe.high_quality:
+            clip = pad_clip(clip, pipe.target_dims)
+        else:
+            clip = apply_resize_to_clip(clip, pipe.target_dims, pipe.high_quality, use_cuda)
+    return ov_clip, clip
+
+def render_overlay_parts(pipe, ov_meta, out_path):
+    """Render the MoviePy video fallback in parallel time slices, then join them and mux the audio.
+
+    Each worker thread opens its own reader, canvas and encoder for its frame range; decoding, cv2.resize
+    and encoding all release the GIL. The parts share encoder settings, so the join is a stream copy.
+    Hardware encoders render in one piece (consumer GPUs cap concurrent sessions).
+    """
+    total = frame_count(pipe)
+    use_cuda = cuda_available()  # checked here, on the script thread
+    parts = min(RENDER_WORKERS, int(pipe.duration // MIN_PART_SECONDS)) if pipe.codec == VIDEO_CODEC else 1
+    if parts < 2:
+        ov_clip, clip = build_overlay_clip(pipe, ov_meta, use_cuda)
+        try:
+            return render_clip_ffmpeg(clip, pipe, out_path)
+        finally:
+            ov_clip.close()
+    
+    bounds = [total * i // parts for i in range(parts + 1)]
+    # Split the cores between the part encoders instead of letting each size its pool to the whole host
+    part_threads = max(1, (os.cpu_count() or 1) // parts)
+    part_paths = [new_temp_path(".mp4") for _ in range(parts)]
+    list_path = new_temp_path(".txt")
+    
+    def render_part(i):
+        ov_clip, clip = build_overlay_clip(pipe, ov_meta, use_cuda)
+        try:
+            return render_clip_ffmpeg(clip, pipe, part_paths[i], (bounds[i], bounds[i + 1]), audio=False,
+                                      threads=part_threads)
+        finally:
+            ov_clip.close()
+    
+    try:
+        with ThreadPoolExecutor(parts) as pool:
+            out_size = list(pool.map(render_part, range(parts)))[0]
+        with open(list_path, "w") as f:
+            f.writelines(f"file '{path}'\n" for path in part_paths)
+        duration = f"{pipe.duration:.3f}"
+        run_ffmpeg([FFMPEG_BINARY, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                    "-ss", f"{pipe.a_trim[0]:.3f}", "-t", duration, "-i", pipe.bg_path,
+                    "-map", "0:v:0", "-map", "1:a:0", "-t", duration,
+                    "-c:v", "copy", *pipe.audio_args, *ENCODE_FLAGS, out_path])
+        return out_size
+    finally:
+        for path in (*part_paths, list_path):
+            remove_temp_file(path)
 
 # Upload section
 c1, c2 = st.columns(2)
@@ -126,49 +719,41 @@ with c1:
         key="bg_uploader"
     )
     
-    if bg and (bg.name != st.session_state.bg_name or not os.path.exists(st.session_state.bg_path)):
+    # Save (and probe) once per upload; later reruns reuse the saved path
+    if bg and (upload_key(bg) != st.session_state.bg_key or not st.session_state.bg_valid):
         try:
+            remove_temp_file(st.session_state.bg_path)
             bg_path = save_file(bg)
             st.session_state.bg_path = bg_path
             st.session_state.bg_name = bg.name
+            st.session_state.bg_key = upload_key(bg)
+            st.session_state.bg_valid = True
             
             # Determine file type
             if is_video_file(bg_path):
-                # Try to load as video first
+                # Probe once (cached); audio-only containers come back with is_video False
                 try:
-                    clip = VideoFileClip(bg_path)
-                    if clip.audio is not None:
-                        bg_duration = float(clip.audio.duration)
+                    info = probe(bg_path)
+                    if info['has_audio']:
+                        bg_duration = info['audio_duration']
                         # SET DEFAULT: Use full audio duration
                         st.session_state.a_trim = [0.0, bg_duration]
                         st.session_state.bg_dur = bg_duration
-                        st.success(f"✅ Video with audio: {bg.name} ({bg_duration:.1f}s)")
+                        kind = "Video with audio" if info['is_video'] else "Audio"
+                        st.success(f"✅ {kind}: {bg.name} ({bg_duration:.1f}s)")
                     else:
-                        # Video without audio, try as audio file
-                        clip.close()
-                        try:
-                            audio = AudioFileClip(bg_path)
-                            bg_duration = float(audio.duration)
-                            st.session_state.a_trim = [0.0, bg_duration]
-                            st.session_state.bg_dur = bg_duration
-                            st.success(f"✅ Audio: {bg.name} ({bg_duration:.1f}s)")
-                            audio.close()
-                        except:
-                            st.error(f"❌ {bg.name} has no audio track")
-                            bg = None
-                    clip.close()
+                        st.error(f"❌ {bg.name} has no audio track")
+                        bg = None
                 except Exception as e:
                     st.error(f"❌ Cannot load video file: {e}")
                     bg = None
             
             elif is_audio_file(bg_path):
                 try:
-                    audio = AudioFileClip(bg_path)
-                    bg_duration = float(audio.duration)
+                    bg_duration = probe(bg_path)['audio_duration']
                     st.session_state.a_trim = [0.0, bg_duration]
                     st.session_state.bg_dur = bg_duration
                     st.success(f"✅ Audio: {bg.name} ({bg_duration:.1f}s)")
-                    audio.close()
                 except Exception as e:
                     st.error(f"❌ Cannot load audio file: {e}")
                     bg = None
@@ -192,17 +777,23 @@ with c2:
         key="ov_uploader"
     )
     
-    if ov and (ov.name != st.session_state.ov_name or not os.path.exists(st.session_state.ov_path)):
+    if ov and (upload_key(ov) != st.session_state.ov_key or not st.session_state.ov_valid):
         try:
-            ov_path = save_file(ov)
-            st.session_state.ov_path = ov_path
+            remove_temp_file(st.session_state.ov_path)
+            st.session_state.ov_path = ''
             st.session_state.ov_name = ov.name
+            st.session_state.ov_key = upload_key(ov)
+            st.session_state.ov_valid = True
             
-            if is_image_file(ov_path):
+            if is_image_file(ov.name):
+                # Images are only ever used decoded (ffmpeg gets a PNG of the final frame), so nothing goes to disk
                 st.session_state.is_img = True
+                st.session_state.img_arr = None
                 try:
-                    img = Image.open(ov_path)
-                    st.image(img, width=300)
+                    # Decode once from the upload buffer; reused for preview and rendering
+                    img_arr = decode_image_rgb(ov.getbuffer())
+                    st.session_state.img_arr = img_arr
+                    st.image(img_arr, width=300)
                     st.success(f"✅ Image: {ov.name}")
                     # For images, set default duration to match audio duration
                     if st.session_state.bg_dur > 0:
@@ -212,17 +803,24 @@ with c2:
                     ov = None
             else:
                 st.session_state.is_img = False
+                st.session_state.img_arr = None
+                ov_path = save_file(ov)
+                st.session_state.ov_path = ov_path
                 try:
-                    ov_clip = VideoFileClip(ov_path, audio=False)
-                    ov_duration = float(ov_clip.duration)
+                    info = probe(ov_path)
+                    if not info['is_video']:
+                        raise ValueError("no video stream found")
+                    ov_duration = info['duration']
                     # SET DEFAULT: Use full video duration
                     st.session_state.v_trim = [0.0, ov_duration]
                     st.session_state.ov_dur = ov_duration
-                    w, h = ov_clip.size
+                    w, h = info['size']
+                    # Keep metadata so rendering doesn't have to probe the file again
+                    st.session_state.ov_meta = {'duration': ov_duration, 'w': w, 'h': h, 'fps': info['fps'],
+                                                'codec': info['video_codec']}
                     orientation = "Portrait" if h > w else "Landscape" if w > h else "Square"
                     st.success(f"✅ Video: {ov.name} ({ov_duration:.1f}s)")
                     st.info(f"📐 {w}×{h} ({orientation})")
-                    ov_clip.close()
                 except Exception as e:
                     st.error(f"❌ Cannot load video: {e}")
                     ov = None
@@ -326,164 +924,206 @@ if bg and ov:
     target_dims = PRESETS[selected_preset]
     
     if target_dims:
-        st.info(f"Will resize to: {target_dims[0]}×{target_dims[1]} (adds black bars to maintain aspect ratio)")
+        # Source size from the upload (decoded image or probed video), when there is one
+        if ov and st.session_state.is_img and st.session_state.img_arr is not None:
+            src_size = st.session_state.img_arr.shape[1::-1]
+        elif ov and not st.session_state.is_img and st.session_state.ov_meta:
+            src_size = (st.session_state.ov_meta['w'], st.session_state.ov_meta['h'])
+        else:
+            src_size = None
+        
+        if src_size and letterbox_geometry(src_size, target_dims)[:2] == tuple(target_dims):
+            st.info(f"Will resize to: {target_dims[0]}×{target_dims[1]} (source {fmt_aspect(src_size)} matches target "
+                    f"{fmt_aspect(target_dims)} - plain resize, no black bars)")
+        elif src_size:
+            st.info(f"Will resize to: {target_dims[0]}×{target_dims[1]} (source {fmt_aspect(src_size)} → target "
+                    f"{fmt_aspect(target_dims)}, adds black bars to maintain aspect ratio)")
+        else:
+            st.info(f"Will resize to: {target_dims[0]}×{target_dims[1]} (adds black bars to maintain aspect ratio)")
+        # Lanczos is several times the work of cubic; only pay for it on request (downscales always use area)
+        quality = st.selectbox("Resize quality", ["Fast (area/cubic)", "High (lanczos4 when enlarging)"], index=0)
+        high_quality = quality.startswith("High")
     else:
         st.info("Original dimensions will be preserved")
+        high_quality = False
+    
+    encode_speed = st.selectbox("Encode speed", ENCODE_SPEEDS, index=ENCODE_SPEEDS.index(ENCODE_PRESET),
+                                help="Faster presets encode several times quicker at the same bitrate; "
+                                     "ultrafast is quickest but noticeably softer at the same bitrate")
+    force_moviepy = st.checkbox("Quality/debug: render with MoviePy", value=False,
+                                help="Use MoviePy's frame-by-frame pipeline instead of a single ffmpeg command (much slower)")
 
 # Process button
 st.divider()
 if st.button("🎬 Create Video", type="primary", disabled=not (bg and ov), use_container_width=True):
     try:
         with st.spinner("Processing video..."):
-            # Load background audio
-            is_vid = is_video_file(st.session_state.bg_path)
-            audio = None
-            audio_src = None
-            
+            # Only check the audio track here (cached probe); every render path has ffmpeg read the audio itself
             try:
-                if is_vid:
-                    audio_src = VideoFileClip(st.session_state.bg_path)
-                    audio = audio_src.audio
-                else:
-                    audio_src = AudioFileClip(st.session_state.bg_path)
-                    audio = audio_src
-                
-                if audio is None:
+                bg_info = probe(st.session_state.bg_path)
+                if not bg_info['has_audio']:
                     raise Exception("No audio track found in file")
-                
-                # Get the selected audio segment
-                trim_start = st.session_state.a_trim[0]
-                trim_end = st.session_state.a_trim[1]
-                
-                # Extract audio segment
-                audio_segment = audio.subclip(trim_start, trim_end)
-                audio_duration = audio_segment.duration
-                
-                st.info(f"🎵 Using audio: {fmt_time(audio_duration)}")
-                
+            except FileNotFoundError:
+                # Swept after a long idle - save the upload again on the next rerun
+                st.session_state.bg_valid = False
+                st.error("❌ The audio upload expired, please click Create Video again")
+                raise
             except Exception as e:
                 st.error(f"❌ Error loading audio: {e}")
                 raise
             
+            if not st.session_state.is_img:
+                try:
+                    touch_temp_file(st.session_state.ov_path)
+                except FileNotFoundError:
+                    st.session_state.ov_valid = False
+                    st.error("❌ The video upload expired, please click Create Video again")
+                    raise
+            
+            # Output file
+            remove_temp_file(st.session_state.out_path)
+            out = new_temp_path(".mp4")
+            st.session_state.out_path = out
+            video_codec = pick_video_codec()
+            if video_codec != VIDEO_CODEC:
+                st.info(f"⚡ Using hardware encoder: {video_codec}")
+            
+            # Keep the overlay's native frame rate so no frames are synthesized/dropped (24 for still images)
+            ov_meta = st.session_state.ov_meta
+            out_fps = 24 if st.session_state.is_img else (ov_meta or {}).get('fps') or 30
+            
+            pipe = Pipeline(bg_path=st.session_state.bg_path, ov_path=st.session_state.ov_path,
+                            is_img=st.session_state.is_img, a_trim=tuple(st.session_state.a_trim),
+                            v_trim=tuple(st.session_state.v_trim), img_dur=st.session_state.img_dur,
+                            target_dims=target_dims, fps=out_fps, codec=video_codec,
+                            high_quality=high_quality, speed=encode_speed, use_ffmpeg=not force_moviepy,
+                            copy_audio=bg_info['audio_codec'] in COPY_AUDIO_CODECS,
+                            src_size=(ov_meta['w'], ov_meta['h']) if ov_meta and not st.session_state.is_img else None)
+            audio_duration = pipe.duration
+            st.info(f"🎵 Using audio: {fmt_time(audio_duration)}")
+            
             # Process overlay
             final = None
             ov_final = None
+            out_size = None
             
             if st.session_state.is_img:
                 try:
-                    # Load and process image
-                    img = Image.open(st.session_state.ov_path)
-                    img_arr = np.array(img)
+                    # Image decoded at upload time (RGB for ImageClip)
+                    img_arr = st.session_state.img_arr
+                    if img_arr is None:
+                        raise ValueError("the image could not be decoded - please upload it again")
+                    # Keep the frame C-contiguous uint8 end to end (no copy if it already is)
+                    img_arr = np.ascontiguousarray(img_arr, dtype=np.uint8)
                     
-                    # Resize image if target dims specified
-                    if target_dims:
-                        img_arr = resize_frame(img_arr, target_dims)
+                    # Resize image once if target dims specified
+                    if pipe.target_dims:
+                        img_arr = resize_frame(img_arr, pipe.target_dims, high_quality=pipe.high_quality)
                     
-                    # Create image clip
-                    img_duration = min(st.session_state.img_dur, audio_duration)
-                    img_clip = ImageClip(img_arr, duration=img_duration)
-                    
-                    # If image duration is shorter than audio, create background
-                    if img_duration < audio_duration:
-                        bg_clip = ColorClip(size=img_clip.size, color=(0, 0, 0), duration=audio_duration)
-                        ov_final = CompositeVideoClip([bg_clip, img_clip.set_position('center')], duration=audio_duration)
-                    else:
-                        ov_final = img_clip.set_duration(audio_duration)
+                    if pipe.use_ffmpeg:
+                        # Still image: hand the final frame to ffmpeg as a PNG and let it loop it,
+                        # so no identical frames go through MoviePy's Python frame loop
+                        still_path = new_temp_path(".png")
+                        try:
+                            cv2.imwrite(still_path, cv2.cvtColor(img_arr, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                            # Already at the output size - ffmpeg only evens it out
+                            render_still_ffmpeg(dataclasses.replace(pipe, target_dims=None), still_path, out)
+                            img_h, img_w = img_arr.shape[:2]
+                            out_size = output_size((img_w, img_h), None)
+                        except RuntimeError as e:
+                            st.warning(f"⚠️ ffmpeg encode failed, falling back to MoviePy: {e}")
+                        finally:
+                            remove_temp_file(still_path)
                     
-                    # Create final video
-                    final = ov_final.set_audio(audio_segment)
+                    if out_size is None:
+                        # Create image clip
+                        img_duration = min(pipe.img_dur, audio_duration)
+                        
+                        # If image duration is shorter than audio, show black after it; both frames are
+                        # the same size, so pick one per t instead of compositing a ColorClip every frame
+                        if img_duration < audio_duration:
+                            black = np.zeros_like(img_arr)
+                            ov_final = VideoClip(lambda t: img_arr if t < img_duration else black, duration=audio_duration)
+                        else:
+                            ov_final = ImageClip(img_arr, duration=img_duration)
+                        
+                        final = ov_final
                     
                 except Exception as e:
                     st.error(f"❌ Error processing image: {e}")
                     raise
             else:
                 try:
-                    # Load video overlay
-                    ov_clip = VideoFileClip(st.session_state.ov_path, audio=False)
-                    
                     # Get selected video segment
-                    v_trim_start = st.session_state.v_trim[0]
-                    v_trim_end = st.session_state.v_trim[1]
+                    v_trim_start, v_trim_end = pipe.v_trim
+                    video_duration = v_trim_end - v_trim_start
                     
-                    # Extract video segment
-                    video_segment = ov_clip.subclip(v_trim_start, v_trim_end)
-                    video_duration = video_segment.duration
+                    # Single ffmpeg pipeline whenever the selection can be expressed as one
+                    if pipe.use_ffmpeg and ov_meta and ffmpeg_can_render(pipe, st.session_state.ov_dur):
+                        st.info(f"🎥 Using video segment: {fmt_time(video_duration)}")
+                        if video_duration < audio_duration:
+                            st.info("🔄 Looping video with ffmpeg to match audio...")
+                        elif video_duration > audio_duration:
+                            st.info("✂️ Trimming video to match audio duration")
+                        # Nothing to scale or loop: copy the compressed video instead of re-encoding it
+                        if can_stream_copy(pipe, ov_meta):
+                            try:
+                                render_copy_ffmpeg(pipe, out)
+                                out_size = (ov_meta['w'], ov_meta['h'])
+                                st.info("⚡ Copied video stream without re-encoding")
+                            except RuntimeError as e:
+                                st.warning(f"⚠️ Stream copy failed, re-encoding: {e}")
+                        if out_size is None:
+                            try:
+                                render_with_ffmpeg(pipe, out)
+                                out_size = output_size((ov_meta['w'], ov_meta['h']), pipe.target_dims)
+                            except RuntimeError as e:
+                                st.warning(f"⚠️ ffmpeg render failed, falling back to MoviePy: {e}")
                     
-                    st.info(f"🎥 Using video segment: {fmt_time(video_duration)}")
-                    
-                    # Loop or trim video to match audio duration
-                    if video_duration < audio_duration:
-                        # Loop the video
-                        loops_needed = int(np.ceil(audio_duration / video_duration))
-                        ov_final = concatenate_videoclips([video_segment] * loops_needed)
-                        ov_final = ov_final.subclip(0, audio_duration)
-                        st.info(f"🔄 Looped video {loops_needed} times to match audio")
-                    elif video_duration > audio_duration:
-                        # Trim the video
-                        ov_final = video_segment.subclip(0, audio_duration)
-                        st.info("✂️ Trimmed video to match audio duration")
-                    else:
-                        # Durations match exactly
-                        ov_final = video_segment
-                    
-                    # Apply resize if needed
-                    if target_dims:
-                        st.info("⏳ Resizing video...")
-                        ov_final = apply_resize_to_clip(ov_final, target_dims)
-                    
-                    # Create final video
-                    final = ov_final.set_audio(audio_segment)
-                    
-                    # Close the original clip
-                    ov_clip.close()
-                    video_segment.close()
+                    if out_size is None:
+                        st.info(f"🎥 Using video segment: {fmt_time(video_duration)}")
+                        if video_duration < audio_duration:
+                            st.info(f"🔄 Looping video {math.ceil(audio_duration / video_duration)} times to match audio")
+                        elif video_duration > audio_duration:
+                            st.info("✂️ Trimming video to match audio duration")
+                        if pipe.target_dims:
+                            st.info("⏳ Resizing video...")
+                        st.info("📹 Rendering video...")
+                        out_size = render_overlay_parts(pipe, ov_meta, out)
                     
                 except Exception as e:
                     st.error(f"❌ Error processing video: {e}")
                     raise
             
-            # Save final video
-            out = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4").name
-            
-            # Write video file
-            st.info("📹 Rendering video...")
-            final.write_videofile(
-                out, 
-                fps=24 if st.session_state.is_img else 30,  # Lower FPS for images to reduce file size
-                codec="libx264", 
-                audio_codec="aac", 
-                bitrate="5M", 
-                verbose=False, 
-                logger=None,
-                preset='medium',
-                threads=4
-            )
+            # Write video file (skipped when ffmpeg already rendered it)
+            if final is not None:
+                st.info("📹 Rendering video...")
+                # Frames stream to ffmpeg, which also muxes the audio segment straight from the upload
+                out_size = render_clip_ffmpeg(final, pipe, out)
         
         st.success("✅ Video created successfully!")
-        st.video(out)
+        # Read the render once and serve both the preview and the download from it, in this same run
+        with open(out, "rb") as f:
+            video_bytes = f.read()
+        remove_temp_file(out)
+        st.session_state.out_path = ''
+        st.video(video_bytes, format="video/mp4")
         
-        w, h = final.size
+        w, h = out_size
         c1, c2, c3 = st.columns(3)
         c1.metric("Duration", f"{audio_duration:.1f}s")
         c2.metric("Resolution", f"{w}×{h}")
-        file_size = os.path.getsize(out) / (1024 * 1024)
+        file_size = len(video_bytes) / (1024 * 1024)
         c3.metric("Size", f"{file_size:.1f}MB")
         
         format_name = selected_preset.split(" - ")[0].replace("📱 ", "").replace("📺 ", "").replace("⬜ ", "").replace(" ", "_")
         
-        with open(out, "rb") as f:
-            st.download_button("📥 Download Video", f, f"{format_name}_{w}x{h}.mp4", "video/mp4", type="primary", use_container_width=True)
+        st.download_button("📥 Download Video", video_bytes, f"{format_name}_{w}x{h}.mp4", "video/mp4", type="primary", use_container_width=True)
         
         # Cleanup - only close at the very end
         try:
-            if audio_segment:
-                audio_segment.close()
-            if audio_src:
-                audio_src.close()
             if ov_final:
                 ov_final.close()
-            if final:
-                final.close()
         except:
             pass
         
@@ -492,10 +1132,16 @@ if st.button("🎬 Create Video", type="primary", disabled=not (bg and ov), use_
         import traceback
         st.code(traceback.format_exc())
 
-# Cleanup old temporary files on rerun
-if st.session_state.get('bg_path') and not os.path.exists(st.session_state.bg_path):
+# Forget saved uploads once the uploader is cleared (no per-rerun stat calls)
+if st.session_state.bg_valid and st.session_state.get('bg_uploader') is None:
+    remove_temp_file(st.session_state.bg_path)
     st.session_state.bg_path = ''
     st.session_state.bg_name = ''
-if st.session_state.get('ov_path') and not os.path.exists(st.session_state.ov_path):
+    st.session_state.bg_key = None
+    st.session_state.bg_valid = False
+if st.session_state.ov_valid and st.session_state.get('ov_uploader') is None:
+    remove_temp_file(st.session_state.ov_path)
     st.session_state.ov_path = ''
     st.session_state.ov_name = ''
+    st.session_state.ov_key = None
+    st.session_state.ov_valid = False